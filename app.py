@@ -1,61 +1,407 @@
+import functools
 import io
+import itertools
 import math
-import tempfile
-from typing import List, Tuple
+import os
+import multiprocessing
+import zipfile
 
+import numpy as np
 import streamlit as st
 import ezdxf
 from ezdxf import recover
-from ezdxf.entities import Line, LWPolyline, Polyline, Point, Circle, Arc, Spline
-from pyproj import Transformer, CRS
-import simplekml
+from ezdxf.entities import LWPolyline, Spline
+from lxml import etree
+from pyproj import Proj, Transformer, CRS
+
+try:
+    from numba import njit
+except ImportError:  # numba is an optional accelerator
+    njit = None
 
 # ------------------------
 # Helpers
 # ------------------------
 
-def get_transformer(input_crs: CRS):
-    """Return a transformer from input CRS to WGS84 (EPSG:4326)."""
-    return Transformer.from_crs(input_crs, CRS.from_epsg(4326), always_xy=True)
+@st.cache_resource(show_spinner=False)
+def get_transformer(epsg: int):
+    """Return a transformer from an EPSG code to WGS84 (EPSG:4326).
 
+    Cached with st.cache_resource, which lives in the Streamlit server
+    rather than this module, so reruns (widget changes, repeated uploads)
+    reuse the same Transformer instead of rebuilding it (~100 ms each
+    time). An lru_cache would not survive reruns: Streamlit re-executes
+    the script into a fresh module, recreating the function and its cache.
+    """
+    return Transformer.from_crs(CRS.from_epsg(epsg), CRS.from_epsg(4326), always_xy=True)
 
-def transform_xy_list(transformer: Transformer, xy: List[Tuple[float, float]]):
-    out = []
-    for x, y in xy:
-        lon, lat = transformer.transform(x, y)
-        out.append((lon, lat))
-    return out
+
+@st.cache_resource(show_spinner=False)
+def get_projector(epsg: int):
+    """Return a callable mapping projected (x, y) arrays to WGS84 lon/lat.
+
+    When the input CRS already sits on the WGS84 datum, a plain inverse
+    Proj call gives the same result as the Transformer while skipping the
+    datum-shift pipeline PROJ would otherwise run per point. Other datums
+    (e.g. NAD83 State Plane) go through the full Transformer. Cached with
+    st.cache_resource for the same rerun-persistence reason as
+    get_transformer.
+    """
+    crs = CRS.from_epsg(epsg)
+    if crs.datum == CRS.from_epsg(4326).datum:
+        return functools.partial(Proj(crs), inverse=True)
+    return get_transformer(epsg).transform
+
+
+@st.cache_resource(show_spinner="Parsing DXF...")
+def load_dxf(data: bytes):
+    """Parse DXF bytes with ezdxf's recover module.
+
+    Cached on the upload contents, so widget changes (segments slider, EPSG,
+    altitude mode) rerun the script without re-parsing the drawing.
+    """
+    return recover.read(io.BytesIO(data))
 
 
 def is_closed_lwpoly(lw: LWPolyline) -> bool:
     if lw.closed:
         return True
-    # If not flagged closed, check first/last equality
-    pts = [(v[0], v[1]) for v in lw]
-    return len(pts) > 2 and (abs(pts[0][0] - pts[-1][0]) < 1e-6 and abs(pts[0][1] - pts[-1][1]) < 1e-6)
+    # If not flagged closed, check first/last equality by index; no need to
+    # materialize a tuple per vertex just to look at the two endpoints
+    if len(lw) <= 2:
+        return False
+    first, last = lw[0], lw[-1]
+    return abs(first[0] - last[0]) < 1e-6 and abs(first[1] - last[1]) < 1e-6
+
+
+if njit is not None:
+    @njit(cache=True, fastmath=True)
+    def _arc_xy(cx, cy, radius, a0, a1, segments):
+        out = np.empty((segments + 1, 2))
+        step = (a1 - a0) / segments
+        for i in range(segments + 1):
+            ang = math.radians(a0 + i * step)
+            out[i, 0] = cx + radius * math.cos(ang)
+            out[i, 1] = cy + radius * math.sin(ang)
+        return out
+
+    # Warm the JIT at import so the first arc in a drawing does not pay
+    # the compile cost; cache=True makes later runs load it from disk.
+    _arc_xy(0.0, 0.0, 1.0, 0.0, 90.0, 4)
+else:
+    _arc_xy = None
 
 
 def arc_to_polyline(center, radius, start_angle, end_angle, segments=64):
-    """Approximate an ARC into vertices in OCS plane (assumes WCS already). Angles in degrees."""
+    """Approximate an ARC into vertices in OCS plane (assumes WCS already). Angles in degrees.
+
+    Returns an (N, 2) numpy array. Uses the Numba-compiled kernel when
+    numba is installed, otherwise vectorized numpy trig.
+    """
     if end_angle < start_angle:
         end_angle += 360.0
-    step = (end_angle - start_angle) / max(1, segments)
-    pts = []
-    for i in range(segments + 1):
-        ang = math.radians(start_angle + i * step)
-        x = center[0] + radius * math.cos(ang)
-        y = center[1] + radius * math.sin(ang)
-        pts.append((x, y))
-    return pts
+    segments = max(1, segments)
+    if _arc_xy is not None:
+        return _arc_xy(center[0], center[1], radius, start_angle, end_angle, segments)
+    angles = np.radians(np.linspace(start_angle, end_angle, segments + 1))
+    return np.column_stack((center[0] + radius * np.cos(angles), center[1] + radius * np.sin(angles)))
 
 
 def spline_to_polyline(spline: Spline, segments=100):
+    """Approximate a SPLINE as an (N, 2) array using ezdxf's BSpline tool.
+
+    BSpline.approximate evaluates the whole parameter range in one pass
+    instead of calling Spline.point once per vertex.
+    """
     try:
-        pts = [spline.point(i / segments) for i in range(segments + 1)]
-        return [(p[0], p[1]) for p in pts]
+        bspline = spline.construction_tool()
+        return np.asarray(list(bspline.approximate(segments)), dtype=np.float64)[:, :2]
     except Exception:
         # Fallback to control points if NURBS evaluation not available
-        return [(p[0], p[1]) for p in spline.control_points]
+        return np.asarray([(p[0], p[1]) for p in spline.control_points], dtype=np.float64).reshape(-1, 2)
+
+
+def _collect_point(e, add, segments):
+    loc = e.dxf.location
+    z = loc.z if hasattr(loc, 'z') else 0.0
+    add("POINT", e.dxf.layer, [(loc.x, loc.y)], z=z)
+
+
+def _collect_line(e, add, segments):
+    add("LINE", e.dxf.layer, [(e.dxf.start.x, e.dxf.start.y), (e.dxf.end.x, e.dxf.end.y)])
+
+
+def _collect_lwpolyline(e, add, segments):
+    # get_points returns all vertices in one call; no tuple per vertex
+    pts = np.asarray(e.get_points('xy'), dtype=np.float64).reshape(-1, 2)
+    add("LWPOLY", e.dxf.layer, pts, closed=is_closed_lwpoly(e))
+
+
+def _collect_polyline(e, add, segments):
+    pts = np.fromiter(
+        (c for v in e.vertices for c in (v.dxf.location.x, v.dxf.location.y)),
+        dtype=np.float64,
+    ).reshape(-1, 2)
+    add("POLYLINE", e.dxf.layer, pts, closed=e.is_closed)
+
+
+def _collect_circle(e, add, segments):
+    center = (e.dxf.center.x, e.dxf.center.y)
+    add("CIRCLE", e.dxf.layer, arc_to_polyline(center, e.dxf.radius, 0.0, 360.0, segments=segments))
+
+
+def _collect_arc(e, add, segments):
+    center = (e.dxf.center.x, e.dxf.center.y)
+    pts = arc_to_polyline(center, e.dxf.radius, e.dxf.start_angle, e.dxf.end_angle, segments=segments)
+    add("ARC", e.dxf.layer, pts)
+
+
+def _collect_spline(e, add, segments):
+    add("SPLINE", e.dxf.layer, spline_to_polyline(e, segments=segments))
+
+
+# One dict lookup on e.dxftype() replaces a chain of isinstance checks per
+# entity. It also keys arcs correctly: ezdxf's Arc subclasses Circle, so the
+# old isinstance ladder swallowed every ARC in the Circle branch and
+# tessellated it as a full circle.
+COLLECTORS = {
+    'POINT': _collect_point,
+    'LINE': _collect_line,
+    'LWPOLYLINE': _collect_lwpolyline,
+    'POLYLINE': _collect_polyline,
+    'CIRCLE': _collect_circle,
+    'ARC': _collect_arc,
+    'SPLINE': _collect_spline,
+}
+
+SUPPORTED_TYPES = ' '.join(COLLECTORS)
+
+
+def supported_entities(msp, layer_whitelist=None):
+    """Select the entities to convert, pruning whole layers up front.
+
+    With a layer whitelist, msp.groupby buckets the modelspace by layer in
+    one pass and only the whitelisted buckets are iterated, so entities on
+    other layers are never inspected at all; the dxftype dispatch in
+    collect_entities drops unsupported types inside the kept buckets.
+    Without a whitelist, a single type query covers the whole modelspace.
+    """
+    if layer_whitelist:
+        groups = msp.groupby(dxfattrib='layer')
+        return itertools.chain.from_iterable(
+            groups[layer] for layer in sorted(layer_whitelist) if layer in groups
+        )
+    return msp.query(SUPPORTED_TYPES)
+
+
+def collect_entities(entities, segments):
+    """Pass 1: gather raw vertices and per-entity metadata.
+
+    Returns ``(pts, meta, skipped)`` where ``pts`` is an (N, 2) float array of
+    raw drawing coordinates, each ``meta`` entry is
+    ``(kind, layer, start, end, closed, z)`` slicing into ``pts``, and
+    ``skipped`` holds messages for entities that could not be processed.
+    Collecting everything first lets the caller run a single batched
+    transform over the whole drawing instead of one pyproj call per entity.
+    """
+    meta = []
+    skipped = []
+    # Preallocated accumulator filled in place with a running index; grown
+    # geometrically, so there is never a Python list of per-entity arrays
+    # plus a concatenated copy in memory at the same time.
+    buf = np.empty((1024, 2), dtype=np.float64)
+    n = 0
+
+    def add(kind, layer, pts, closed=False, z=0.0):
+        nonlocal buf, n
+        arr = np.asarray(pts, dtype=np.float64).reshape(-1, 2)
+        if len(arr) == 0:
+            return
+        need = n + len(arr)
+        if need > len(buf):
+            grown = np.empty((max(need, 2 * len(buf)), 2), dtype=np.float64)
+            grown[:n] = buf[:n]
+            buf = grown
+        buf[n:need] = arr
+        meta.append((kind, layer, n, need, closed, z))
+        n = need
+
+    for e in entities:
+        collector = COLLECTORS.get(e.dxftype())
+        if collector is None:
+            continue
+        try:
+            collector(e, add, segments)
+        except Exception as ex:
+            skipped.append(f"Skipped {e.dxftype()} on layer {getattr(e.dxf, 'layer', '?')}: {ex}")
+
+    return buf[:n], meta, skipped
+
+
+KML_NS = "http://www.opengis.net/kml/2.2"
+
+
+def coords_block(lons, lats):
+    """Format a run of coordinates as one KML <coordinates> text block.
+
+    Both columns are rendered by numpy at a fixed 7 decimals (roughly
+    centimeter precision), which halves the output size versus Python's
+    default 17-significant-digit float repr and keeps the per-vertex
+    formatting out of the interpreter loop. A single str.join then builds
+    the block in linear time.
+    """
+    lines = np.char.add(np.char.mod('%.7f,', np.asarray(lons)), np.char.mod('%.7f,0', np.asarray(lats)))
+    return '\n'.join(lines)
+
+
+# Below this many vertices the pool startup costs more than it saves.
+PARALLEL_MIN_VERTICES = 50_000
+
+# Workers must inherit this module by forking: Streamlit runs the script in
+# a synthetic __main__ module, so a spawned interpreter could not re-import
+# it to resolve _format_chunk. Without fork (e.g. Windows) we stay inline.
+try:
+    _MP_FORK = multiprocessing.get_context('fork')
+except ValueError:
+    _MP_FORK = None
+
+
+def _format_chunk(args):
+    """Transform one contiguous vertex chunk and render its coord blocks.
+
+    Runs either inline or in a Pool worker. The projection callable is
+    rebuilt from the EPSG code through the lru_cache instead of being
+    pickled across the process boundary.
+    """
+    epsg, pts, spans = args
+    lons, lats = get_projector(epsg)(pts[:, 0], pts[:, 1])
+    out = []
+    for start, end, is_point, z in spans:
+        if is_point:
+            out.append(f"{lons[start]:.7f},{lats[start]:.7f},{z}")
+        else:
+            out.append(coords_block(lons[start:end], lats[start:end]))
+    return out
+
+
+def transform_and_format(epsg, pts, meta):
+    """Transform raw vertices and render the coordinate text per entity.
+
+    Large drawings are split into contiguous vertex ranges on entity
+    boundaries and farmed out to a fork-based process pool, so the pyproj
+    transform and the string formatting run on all cores. Small drawings,
+    and platforms without fork, stay in-process.
+    Returns one coordinate text block per ``meta`` entry, in order.
+    """
+    spans = [(start, end, kind == "POINT", z) for kind, layer, start, end, closed, z in meta]
+    if not spans:
+        return []
+
+    workers = os.cpu_count() or 1
+    if _MP_FORK is None or len(pts) < PARALLEL_MIN_VERTICES or workers == 1:
+        return _format_chunk((epsg, pts, spans))
+
+    target = math.ceil(len(pts) / workers)
+    jobs = []
+    chunk_spans = []
+    base = None
+    for start, end, is_point, z in spans:
+        if base is None:
+            base = start
+        chunk_spans.append((start - base, end - base, is_point, z))
+        if end - base >= target:
+            jobs.append((epsg, pts[base:end], chunk_spans))
+            chunk_spans = []
+            base = None
+    if chunk_spans:
+        jobs.append((epsg, pts[base:spans[-1][1]], chunk_spans))
+
+    with _MP_FORK.Pool(min(workers, len(jobs))) as pool:
+        results = pool.map(_format_chunk, jobs)
+    return [block for chunk in results for block in chunk]
+
+
+def _text_element(tag, text):
+    el = etree.Element(tag)
+    el.text = text
+    return el
+
+
+def _write_placemark(xf, name, geometry, coord_text, altitude_mode):
+    """Emit one <Placemark> through the incremental writer."""
+    with xf.element('Placemark'):
+        xf.write(_text_element('name', name))
+        with xf.element(geometry):
+            xf.write(_text_element('altitudeMode', altitude_mode))
+            if geometry == 'Polygon':
+                with xf.element('outerBoundaryIs'), xf.element('LinearRing'):
+                    xf.write(_text_element('coordinates', coord_text))
+            else:
+                xf.write(_text_element('coordinates', coord_text))
+
+
+def _write_lines_placemark(xf, name, coord_blocks, altitude_mode):
+    """Emit one <Placemark> holding a layer's linestrings as MultiGeometry."""
+    with xf.element('Placemark'):
+        xf.write(_text_element('name', name))
+        with xf.element('MultiGeometry'):
+            for block in coord_blocks:
+                with xf.element('LineString'):
+                    xf.write(_text_element('altitudeMode', altitude_mode))
+                    xf.write(_text_element('coordinates', block))
+
+
+def build_kml(meta, coord_texts, altitude_mode):
+    """Pass 2: stream the formatted coordinate blocks into KML bytes.
+
+    Entities are grouped into one <Folder> per layer, and a layer's
+    linestrings are merged into a single MultiGeometry Placemark, so the
+    document carries one wrapper per layer instead of one per entity.
+    Everything is written incrementally into a BytesIO via lxml's xmlfile,
+    so large drawings never hold a full document tree plus its serialized
+    string in memory at the same time.
+    """
+    by_layer = {}
+    for entry, block in zip(meta, coord_texts):
+        by_layer.setdefault(entry[1], []).append((entry, block))
+
+    buf = io.BytesIO()
+    count = {"points": 0, "lines": 0, "polylines": 0, "polygons": 0}
+
+    with etree.xmlfile(buf, encoding='utf-8') as xf:
+        xf.write_declaration()
+        with xf.element('kml', nsmap={None: KML_NS}):
+            with xf.element('Document'):
+                for layer, items in by_layer.items():
+                    with xf.element('Folder'):
+                        xf.write(_text_element('name', layer))
+                        line_blocks = []
+                        for (kind, _, start, end, closed, z), block in items:
+                            if kind == "POINT":
+                                _write_placemark(xf, f"POINT:{layer}", 'Point', block, altitude_mode)
+                                count["points"] += 1
+                            elif closed and (end - start) >= 3:
+                                _write_placemark(xf, f"POLY:{layer}", 'Polygon', block, altitude_mode)
+                                count["polygons"] += 1
+                            else:
+                                line_blocks.append(block)
+                                count["lines" if kind == "LINE" else "polylines"] += 1
+                        if line_blocks:
+                            _write_lines_placemark(xf, f"LINES:{layer}", line_blocks, altitude_mode)
+
+    return buf.getvalue(), count
+
+
+def to_kmz(kml_bytes: bytes) -> bytes:
+    """Package KML bytes as a KMZ archive (a zip holding doc.kml).
+
+    XML compresses very well, so the download payload typically shrinks
+    5-20x versus the raw KML.
+    """
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED, compresslevel=6) as z:
+        z.writestr('doc.kml', kml_bytes)
+    return buf.getvalue()
 
 
 # ------------------------
@@ -90,12 +436,9 @@ with st.sidebar:
 uploaded = st.file_uploader("Upload DXF", type=["dxf"]) 
 
 if uploaded:
-    # Read DXF from UploadedFile by writing to a temp file, then using ezdxf.recover
+    # Read DXF straight from the UploadedFile bytes; no temp-file round trip
     try:
-        with tempfile.NamedTemporaryFile(suffix=".dxf", delete=True) as tmp:
-            tmp.write(uploaded.getbuffer())
-            tmp.flush()
-            doc, auditor = recover.readfile(tmp.name)
+        doc, auditor = load_dxf(uploaded.getvalue())
         if auditor.has_errors:
             st.warning(f"DXF recovered with {len(auditor.errors)} issue(s). Proceeding.")
         msp = doc.modelspace()
@@ -110,104 +453,27 @@ if uploaded:
 
     # Set up transform
     try:
-        input_crs = CRS.from_epsg(int(input_epsg))
-        transformer = get_transformer(input_crs)
+        get_projector(int(input_epsg))
     except Exception as e:
         st.error(f"Invalid EPSG {input_epsg}: {e}")
         st.stop()
 
-    kml = simplekml.Kml()
-    kml_alt = {
-        "clampToGround": simplekml.AltitudeMode.clamptoground,
-        "absolute": simplekml.AltitudeMode.absolute,
-        "relativeToGround": simplekml.AltitudeMode.relativetoground,
-    }[elevation_mode]
-
-    count = {"points": 0, "lines": 0, "polylines": 0, "polygons": 0}
+    # Pass 1: collect raw vertices, then transform the whole drawing at once
+    pts, meta, skipped = collect_entities(supported_entities(msp, layer_whitelist), approx_segments)
+    for msg in skipped:
+        st.warning(msg)
 
-    def layer_ok(ent_layer: str) -> bool:
-        return (layer_whitelist is None) or (ent_layer in layer_whitelist)
-
-    # Iterate entities
-    for e in msp:
-        try:
-            if isinstance(e, Point) and layer_ok(e.dxf.layer):
-                x, y, z = e.dxf.location.x, e.dxf.location.y, e.dxf.location.z if hasattr(e.dxf.location, 'z') else 0.0
-                lon, lat = transformer.transform(x, y)
-                p = kml.newpoint(name=f"POINT:{e.dxf.layer}", coords=[(lon, lat, z)])
-                p.altitudemode = kml_alt
-                count["points"] += 1
-
-            elif isinstance(e, Line) and layer_ok(e.dxf.layer):
-                p1 = (e.dxf.start.x, e.dxf.start.y)
-                p2 = (e.dxf.end.x, e.dxf.end.y)
-                coords = transform_xy_list(transformer, [p1, p2])
-                ls = kml.newlinestring(name=f"LINE:{e.dxf.layer}", coords=[(lon, lat, 0.0) for lon, lat in coords])
-                ls.altitudemode = kml_alt
-                count["lines"] += 1
-
-            elif isinstance(e, LWPolyline) and layer_ok(e.dxf.layer):
-                pts = [(v[0], v[1]) for v in e]
-                coords = transform_xy_list(transformer, pts)
-                if is_closed_lwpoly(e) and len(coords) >= 3:
-                    pg = kml.newpolygon(name=f"POLY:{e.dxf.layer}")
-                    pg.outerboundaryis = [(lon, lat, 0.0) for lon, lat in coords]
-                    pg.altitudemode = kml_alt
-                    count["polygons"] += 1
-                else:
-                    ls = kml.newlinestring(name=f"LWPOLY:{e.dxf.layer}", coords=[(lon, lat, 0.0) for lon, lat in coords])
-                    ls.altitudemode = kml_alt
-                    count["polylines"] += 1
-
-            elif isinstance(e, Polyline) and layer_ok(e.dxf.layer):
-                pts = [(v.dxf.location.x, v.dxf.location.y) for v in e.vertices]
-                coords = transform_xy_list(transformer, pts)
-                closed = e.is_closed
-                if closed and len(coords) >= 3:
-                    pg = kml.newpolygon(name=f"POLY:{e.dxf.layer}")
-                    pg.outerboundaryis = [(lon, lat, 0.0) for lon, lat in coords]
-                    pg.altitudemode = kml_alt
-                    count["polygons"] += 1
-                else:
-                    ls = kml.newlinestring(name=f"POLYLINE:{e.dxf.layer}", coords=[(lon, lat, 0.0) for lon, lat in coords])
-                    ls.altitudemode = kml_alt
-                    count["polylines"] += 1
-
-            elif isinstance(e, Circle) and layer_ok(e.dxf.layer):
-                center = (e.dxf.center.x, e.dxf.center.y)
-                pts = arc_to_polyline(center, e.dxf.radius, 0.0, 360.0, segments=approx_segments)
-                coords = transform_xy_list(transformer, pts)
-                ls = kml.newlinestring(name=f"CIRCLE:{e.dxf.layer}", coords=[(lon, lat, 0.0) for lon, lat in coords])
-                ls.altitudemode = kml_alt
-                count["polylines"] += 1
-
-            elif isinstance(e, Arc) and layer_ok(e.dxf.layer):
-                center = (e.dxf.center.x, e.dxf.center.y)
-                pts = arc_to_polyline(center, e.dxf.radius, e.dxf.start_angle, e.dxf.end_angle, segments=approx_segments)
-                coords = transform_xy_list(transformer, pts)
-                ls = kml.newlinestring(name=f"ARC:{e.dxf.layer}", coords=[(lon, lat, 0.0) for lon, lat in coords])
-                ls.altitudemode = kml_alt
-                count["polylines"] += 1
-
-            elif isinstance(e, Spline) and layer_ok(e.dxf.layer):
-                pts = spline_to_polyline(e, segments=approx_segments)
-                coords = transform_xy_list(transformer, pts)
-                ls = kml.newlinestring(name=f"SPLINE:{e.dxf.layer}", coords=[(lon, lat, 0.0) for lon, lat in coords])
-                ls.altitudemode = kml_alt
-                count["polylines"] += 1
-
-        except Exception as ex:
-            st.warning(f"Skipped {e.dxftype()} on layer {getattr(e.dxf, 'layer', '?')}: {ex}")
+    coord_texts = transform_and_format(int(input_epsg), pts, meta)
 
-    # Write to memory and offer download
-    xml = kml.kml()
+    # Pass 2: stream transformed coordinates into KML bytes
+    kml_bytes, count = build_kml(meta, coord_texts, elevation_mode)
 
     st.success(f"KML created | points: {count['points']}  lines: {count['lines']}  polylines: {count['polylines']}  polygons: {count['polygons']}")
     st.download_button(
-        label="Download KML",
-        data=xml.encode("utf-8"),
-        file_name="export.kml",
-        mime="application/vnd.google-earth.kml+xml",
+        label="Download KMZ",
+        data=to_kmz(kml_bytes),
+        file_name="export.kmz",
+        mime="application/vnd.google-earth.kmz",
     )
 
     with st.expander("Details"):